@@ -5,26 +5,64 @@
 # Setup:
 # python3 -m venv venv && source venv/bin/activate && pip install -r requirements.txt
 #
-# Usage: ./epf2parquet.py <output_directory>
+# Usage: ./epf2parquet.py <output_directory> [workers]
 # pbzip2 -cd application.tbz | python ./epf2parquet.py out/application
+#
+# workers is the number of processes to parse with (default 1, parsing on a single thread), which helps on very large files
 
 
+import os
 import sys
 import re
+import queue
+import threading
+import multiprocessing
+from functools import partial
 import pandas as pd
-import dask.dataframe as dd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 pat = r"^([a-z]+)([0-9]{4})([0-9]{2})([0-9]{2})\/([a-z_]+)"
 
-def read_header_info(file=sys.stdin):
+DELIMITER = b'\x02\n'
+BLOCK_SIZE = 1 << 20
+READ_AHEAD = 8
+PARSE_AHEAD = 4
+DATA_PAGE_SIZE = 1 << 20
+
+# arrow type for each EPF database type, anything else is a string
+EPF_TYPES = {
+    'INTEGER': pa.int64(),
+    'BIGINT': pa.int64(),
+    'REAL': pa.float64(),
+    'DOUBLE': pa.float64(),
+    'BOOLEAN': pa.bool_()
+}
+
+def chunk_reader(file):
+    """
+    Returns a function that reads the next chunk (up to BLOCK_SIZE) of file, or b'' at EOF.
+    Real files and pipes are read with os.read, bypassing python's buffered reader: the read-ahead thread
+    would otherwise hold its lock while blocked on the pipe, and python aborts if it's still held at exit.
+    """
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return partial(file.read, BLOCK_SIZE)
+    return partial(os.read, fd, BLOCK_SIZE)
+
+def read_header_info(file=sys.stdin.buffer):
     """
     Extracts header information from the EPF file before processing the data rows.
-    Returns a dictionary with header metadata and the position to resume reading.
+    Returns a dictionary with header metadata and the unconsumed bytes to resume reading from.
     """
-    buffer = ""
-    delimiter = '\x02\n'
+    read_chunk = chunk_reader(file)
+    buffer = bytearray()
+    pos = 0
     column_names = []
     types = []
     primary_keys = []
@@ -33,47 +71,50 @@ def read_header_info(file=sys.stdin):
     group = None
     export_mode = None
 
+    def next_record():
+        """
+        Returns the next record (without delimiter), reading more blocks as needed, or None on EOF
+        """
+        nonlocal pos
+        while True:
+            idx = buffer.find(DELIMITER, pos)
+            if idx != -1:
+                record = bytes(buffer[pos:idx])
+                pos = idx + len(DELIMITER)
+                return record
+            chunk = read_chunk()
+            if not chunk:  # EOF
+                return None
+            buffer.extend(chunk)
+
     # Read first line for column names
     while True:
-        chunk = file.read(1)
-        if not chunk:  # EOF
+        record = next_record()
+        if record is None:
             return None  # No header found
-        buffer += chunk
-        if buffer.endswith(delimiter):
-            line = buffer.replace('\x02\n', '')
-            if '#' in line:
-                [tarjunk, header_text] = line.split('#', 1)
-                column_names = header_text.split('\x01')
-                m = re.match(pat, tarjunk)
-                if m:
-                    group = m.group(1)
-                    name = m.group(5)
-                    date = [m.group(2), m.group(3), m.group(4)]
-                buffer = ""
-                break
-            else:
-                buffer = ""
-                continue  # Skip lines without header marker
+        # the tar-header in front of the first line is binary junk, so don't be strict about it
+        line = record.decode('utf-8', errors='replace')
+        if '#' in line:
+            [tarjunk, header_text] = line.split('#', 1)
+            column_names = header_text.split('\x01')
+            m = re.match(pat, tarjunk)
+            if m:
+                group = m.group(1)
+                name = m.group(5)
+                date = [m.group(2), m.group(3), m.group(4)]
+            break
+        # Skip lines without header marker
 
     # Read metadata lines
-    header_complete = False
-    line_count = 1
-
-    while not header_complete:
-        buffer = ""
-        while True:
-            chunk = file.read(1)
-            if not chunk:  # EOF
-                return None  # Incomplete header
-            buffer += chunk
-            if buffer.endswith(delimiter):
-                break
-
-        line = buffer.replace('\x02\n', '')
-        line_count += 1
-
-        if line.startswith('#'):
-            v = line[1:].split(':', 1)
+    while True:
+        start = pos
+        record = next_record()
+        if record is None:
+            return None  # Incomplete header
+
+        # only metadata lines get decoded, the first data line is left for the (lenient) data parsers
+        if record.startswith(b'#'):
+            v = record[1:].decode('utf-8').split(':', 1)
             if len(v) == 2:
                 if v[0] == 'primaryKey':
                     primary_keys = v[1].split('\x01')
@@ -82,12 +123,8 @@ def read_header_info(file=sys.stdin):
                 elif v[0] == 'exportMode':
                     export_mode = v[1]
         else:
-            # First data line reached - return to this position to start data reading
-            # We'll put the first data line back so it can be processed with the rest
-            header_complete = True
-
-            # Store the first data line for later processing
-            first_data_line = line
+            # First data line reached - keep it (and whatever else we already read) for data processing
+            break
 
     return {
         'column_names': column_names,
@@ -97,183 +134,326 @@ def read_header_info(file=sys.stdin):
         'name': name,
         'group': group,
         'export_mode': export_mode,
-        'first_data_line': first_data_line
+        'buffer': bytes(buffer[start:])
     }
 
+def in_background(iterable, depth):
+    """
+    Generator of the items of iterable, which is consumed on a background thread.
+    Up to depth items are buffered, so the producer and the consumer run at the same time.
+    Exceptions from the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put(item)
+            items.put(done)
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def grow_pipe(file, size=BLOCK_SIZE):
+    """
+    If file is a pipe (on Linux), grow its kernel buffer from the default 64K to size,
+    so each read returns more data and the decompressor can get further ahead of us.
+    """
+    try:
+        import fcntl
+        fcntl.fcntl(file.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except (ImportError, AttributeError, OSError, ValueError):
+        pass  # not Linux, not a pipe, or over the user's pipe-max-size: keep the default
+
+def read_ahead(file=sys.stdin.buffer, depth=READ_AHEAD):
+    """
+    Generator of BLOCK_SIZE chunks of file, read on a background thread.
+    Up to depth chunks are buffered, so the decompressor on the other end of the pipe
+    keeps going while we parse, instead of blocking on a full pipe.
+    """
+    grow_pipe(file)
+    return in_background(iter(chunk_reader(file), b''), depth)
+
+def read_blocks(file=sys.stdin.buffer, buffer=b''):
+    """
+    Generator of blocks of whole EPF records (bytes, delimiters included).
+    Collects at least BLOCK_SIZE and cuts it after the last delimiter with bytes.rfind, so the scan happens in C.
+    """
+    # a pipe hands over whatever is ready (64K at a time, without grow_pipe), so collect chunks in a list
+    # and join them once there's a full block, rather than copying a growing buffer on every read
+    chunks = [buffer]
+    size = len(buffer)
+    wanted = BLOCK_SIZE
+    for chunk in read_ahead(file):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size < wanted:
+            continue
+        buf = b''.join(chunks)
+        # only the last delimiter matters here (arrow finds the rest), and rfind stops at it,
+        # instead of comparing every byte like a numpy mask over the block would
+        end = buf.rfind(DELIMITER)
+        if end == -1:
+            # a record bigger than a block: wait for another block's worth before looking again
+            chunks = [buf]
+            wanted = size + BLOCK_SIZE
+            continue
+        end += len(DELIMITER)
+        yield buf[:end]
+        chunks = [buf[end:]]
+        size = len(chunks[0])
+        wanted = BLOCK_SIZE
+    buf = b''.join(chunks)
+    if buf:
+        yield buf
+
 def process_epf_line(line, column_names):
     """
-    Process a single EPF line and return a dictionary with the data.
+    Process a single EPF line and return its list of fields, or None if it has the wrong number of them.
     This function is pure and doesn't modify any external state.
     """
-    line = line.replace('\x02\n', '')
-
     fields = line.split('\x01')
     if len(fields) == len(column_names):
-        row = {column_names[index]: fields[index] for index in range(len(column_names))}
-        return row
+        return fields
     else:
-        print(f"Skipped line due to bad formatting - expected {len(column_names)} fields, got {len(fields)}")
         return None
 
-def parse_epf(header_info, file=sys.stdin):
+def parse_epf(header_info, lines):
     """
-    Generator to parse EPF file with the header info already extracted.
+    Parse a batch of EPF lines with the header info already extracted, into a sequence of raw strings per column.
+    Returns the columns and the number of rows in them.
     """
     column_names = header_info['column_names']
+    rows = []
 
-    # Process the first data line that we already read during header parsing
-    if 'first_data_line' in header_info and header_info['first_data_line']:
-        row = process_epf_line(header_info['first_data_line'] + '\x02\n', column_names)
-        if row:
-            yield row
+    for line in lines:
+        if line:
+            fields = process_epf_line(line, column_names)
+            if fields:
+                rows.append(fields)
 
-    # Process the rest of the file
-    buffer = ""
-    delimiter = '\x02\n'
-    while True:
-        chunk = file.read(1)
-        if not chunk:  # EOF
-            if buffer:
-                row = process_epf_line(buffer, column_names)
-                if row:
-                    yield row
-            break
-        buffer += chunk
-        if buffer.endswith(delimiter):
-            row = process_epf_line(buffer, column_names)
-            if row:
-                yield row
-            buffer = ""
-
-def get_safe_type_converter(db_type):
-    """
-    Returns a safe type conversion function based on the EPF database type
-    that can handle empty strings and invalid data.
-    """
-    if db_type in ('INTEGER', 'BIGINT'):
-        def convert_int(value):
-            try:
-                return pd.NA if value == '' else int(value)
-            except (ValueError, TypeError):
-                return pd.NA
-        return convert_int
-
-    elif db_type in ('REAL', 'DOUBLE'):
-        def convert_float(value):
-            try:
-                return pd.NA if value == '' else float(value)
-            except (ValueError, TypeError):
-                return pd.NA
-        return convert_float
-
-    elif db_type == 'BOOLEAN':
-        def convert_bool(value):
-            if value == '':
-                return pd.NA
-            try:
-                return bool(int(value))
-            except (ValueError, TypeError):
-                return pd.NA
-        return convert_bool
+    if not rows:
+        return [[] for _ in column_names], 0
+
+    # transposing with zip happens in C, instead of appending every value to its column from python
+    return list(zip(*rows)), len(rows)
+
+def cast_column(values, arrow_type):
+    """
+    Casts a column of EPF strings to an arrow type from EPF_TYPES, in one vectorized pass.
+    Empty strings and invalid data become null.
+    """
+    column = pa.array(values, pa.string())
+
+    if arrow_type in (pa.int64(), pa.bool_()):
+        # arrow's cast fails on the whole column for one bad value, so null those out first
+        # int() accepts a leading + and leading zeros, arrow's cast doesn't and they'd throw off the range check below
+        column = pc.replace_substring_regex(pc.utf8_trim_whitespace(column), r'^(?:\+|(-))?0*([0-9])', r'\1\2')
+        valid = pc.match_substring_regex(column, r'^-?[0-9]{1,19}$')
+        # only 19 digits can overflow an int64, and at the same length, comparing strings compares the numbers
+        length = pc.utf8_length(column)
+        overflow = pc.or_(
+            pc.and_(pc.equal(length, 19), pc.greater(column, '9223372036854775807')),
+            pc.and_(pc.equal(length, 20), pc.greater(column, '-9223372036854775808'))
+        )
+        valid = pc.and_(valid, pc.invert(overflow))
+        numbers = pc.cast(pc.if_else(valid, column, pa.scalar(None, pa.string())), pa.int64())
+        return pc.not_equal(numbers, 0) if arrow_type == pa.bool_() else numbers
+
+    elif arrow_type == pa.float64():
+        # valid floats are too many shapes for a regex, but pandas can coerce them in C
+        # (it returns an integer series when everything looks like an int, so make it float before arrow does a safe cast)
+        numbers = pd.to_numeric(pd.Series(values, dtype='string'), errors='coerce').astype('float64')
+        return pa.array(numbers, pa.float64(), from_pandas=True)
 
     else:  # Default to string
-        return lambda x: x  # No conversion needed
+        return column
+
+def get_db_types(header_info):
+    """
+    Returns the EPF database type of each column, treating them all as strings if dbTypes is missing or doesn't match
+    """
+    column_names = header_info['column_names']
+    types = header_info['types']
+    if not types or len(types) != len(column_names):
+        return ['VARCHAR'] * len(column_names)
+    return types
+
+def get_arrow_type(db_type):
+    """
+    Returns the arrow type to use for an EPF database type
+    """
+    return EPF_TYPES.get(db_type, pa.string())
+
+def get_arrow_schema(header_info):
+    """
+    Returns the arrow schema of the parquet output, based on header info
+    """
+    return pa.schema([(col, get_arrow_type(db_type)) for col, db_type in zip(header_info['column_names'], get_db_types(header_info))])
+
+def parse_block(block, header_info, schema):
+    """
+    Parse a block of whole EPF records into an arrow table, using arrow's CSV parser.
+    Returns the table and the number of lines skipped for having the wrong number of fields.
+    Arrow splits lines on any \n or \r, so when those show up inside values, they are swapped
+    for \x03/\x04, and swapped back in the string columns after parsing.
+    Blocks that need that, but already have \x03 or \x04 in them, raise ArrowInvalid so the row parser takes them.
+    """
+    masked = b'\r' in block or block.count(b'\n') != block.count(DELIMITER)
+    skipped = 0
+
+    def skip_invalid_row(row):
+        nonlocal skipped
+        skipped += 1
+        return 'skip'
+
+    if masked:
+        if b'\x03' in block or b'\x04' in block:
+            raise pa.ArrowInvalid("block has line breaks in values and \\x03 or \\x04, which can't be masked")
+        block = block.replace(b'\r', b'\x04').replace(b'\n', b'\x03').replace(b'\x02\x03', b'\n')
+    else:
+        block = block.replace(DELIMITER, b'\n')
+
+    # threaded parsing with a python invalid_row_handler can abort the interpreter on exit, and blocks are small anyway
+    table = pacsv.read_csv(
+        pa.BufferReader(block),
+        read_options=pacsv.ReadOptions(column_names=schema.names, use_threads=False),
+        parse_options=pacsv.ParseOptions(delimiter='\x01', quote_char=False, invalid_row_handler=skip_invalid_row),
+        # only 1/0 are booleans, like bool(int(value)): anything else (eg "true") fails, and goes to the row parser
+        convert_options=pacsv.ConvertOptions(column_types=schema, true_values=['1'], false_values=['0'])
+    )
 
-def stream_to_parquet_with_dask(header_info, output_file, file=sys.stdin, batch_size=10000):
+    if masked:
+        for i, field in enumerate(schema):
+            if field.type == pa.string():
+                column = pc.replace_substring(table.column(i), '\x03', '\n')
+                column = pc.replace_substring(column, '\x04', '\r')
+                table = table.set_column(i, field, column)
+    return table, skipped
+
+def parse_block_rows(block, header_info, schema):
     """
-    Convert stream to parquet using Dask for better performance
+    Parse a block of whole EPF records into an arrow table, row by row.
+    Returns the table and the number of lines skipped for having the wrong number of fields.
+    This is slow, but tolerates bad data (invalid numbers become null, invalid UTF-8 is replaced)
+    so it's used for blocks that arrow's CSV parser rejects.
     """
-    # Create type converters based on header info
-    converters = {}
-    if header_info['types'] and len(header_info['types']) == len(header_info['column_names']):
-        for i, col in enumerate(header_info['column_names']):
-            converters[col] = get_safe_type_converter(header_info['types'][i])
+    # decode and split the whole block in one go, rather than one record at a time
+    lines = block.decode('utf-8', errors='replace').split('\x02\n')
+    # the raw strings come back per column, so each column can be cast at once
+    columns, n_rows = parse_epf(header_info, lines)
+
+    table = pa.Table.from_arrays([cast_column(column, field.type) for column, field in zip(columns, schema)], schema=schema)
+    skipped = len(lines) - lines.count('') - n_rows
+    return table, skipped
 
-    # Collect batches first
-    all_batches = []
+def parse_any_block(block, header_info, schema):
+    """
+    Parse a block of whole EPF records with arrow, or with the row parser if arrow rejects it.
+    Returns the table and the number of lines skipped for having the wrong number of fields.
+    """
+    try:
+        return parse_block(block, header_info, schema)
+    except pa.ArrowInvalid as e:
+        print(f"Warning: falling back to row parser for block: {e}")
+        return parse_block_rows(block, header_info, schema)
+
+def parse_blocks(header_info, file, schema, workers=1):
+    """
+    Generator of (arrow table, skipped line count) parsed from the data blocks in file, in order.
+    With more than 1 worker, blocks are parsed in a pool of processes.
+    """
+    blocks = read_blocks(file, header_info['buffer'])
+    if workers <= 1:
+        for block in blocks:
+            yield parse_any_block(block, header_info, schema)
+        return
+
+    # imap would otherwise pull the whole input into memory, so only let a few blocks get ahead of the results
+    pending = threading.Semaphore(workers * 2)
+
+    def throttled():
+        for block in blocks:
+            pending.acquire()
+            yield block
+
+    # spawn, because forking a process that is running threads can deadlock the children
+    header = {key: value for key, value in header_info.items() if key != 'buffer'}
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for result in pool.imap(partial(parse_any_block, header_info=header, schema=schema), throttled()):
+            pending.release()
+            yield result
+
+def stream_to_parquet(header_info, output_file, file=sys.stdin.buffer, batch_size=10000, workers=1):
+    """
+    Convert stream to parquet, parsing blocks with arrow on a background thread (or a pool of worker processes)
+    and writing a row group every batch_size rows
+    """
+    schema = get_arrow_schema(header_info)
+    writer = None
     total_rows = 0
+    bad_rows = 0
+
+    # Parsed tables waiting to be written as one row group
+    current_batch = []
+    current_rows = 0
 
-    # Create iterator with progress bar
-    stream = parse_epf(header_info, file)
+    # parsing and writing both release the GIL for most of their work, so they overlap
     with tqdm(desc=f"Processing {header_info['name']}", unit=" row") as pbar:
-        while True:
-            # Get a batch of rows
+        def write_batch():
+            nonlocal writer, total_rows, current_batch, current_rows
+            if writer is None:
+                os.makedirs(output_file, exist_ok=True)
+                # EPF text repeats a lot, so dictionaries + zstd shrink it well, and ids/dates are mostly
+                # sequential or constant, which delta-encodes to almost nothing (can't be combined with a dictionary)
+                writer = pq.ParquetWriter(
+                    os.path.join(output_file, 'part.0.parquet'),
+                    schema,
+                    compression='zstd',
+                    compression_level=3,
+                    use_dictionary=[field.name for field in schema if field.type != pa.int64()],
+                    column_encoding={field.name: 'DELTA_BINARY_PACKED' for field in schema if field.type == pa.int64()},
+                    data_page_size=DATA_PAGE_SIZE
+                )
+            # concat_tables doesn't copy, so the batch is written as a single row group, then dropped
+            writer.write_table(pa.concat_tables(current_batch), row_group_size=current_rows)
+            total_rows += current_rows
+            pbar.update(current_rows)
             current_batch = []
-            for _ in range(batch_size):
-                try:
-                    row = next(stream)
-                    # Apply type conversion and clean values
-                    cleaned_row = {}
-                    for key, value in row.items():
-                        if key in converters:
-                            cleaned_row[key] = converters[key](value)
-                        else:
-                            if not isinstance(value, (str, int, float, bool, type(None))):
-                                cleaned_row[key] = str(value)
-                            else:
-                                cleaned_row[key] = value
-                    current_batch.append(cleaned_row)
-                except StopIteration:
-                    break
-
-            # If we got some rows, add them
-            if current_batch:
-                # Convert batch to DataFrame and add to list
-                df = pd.DataFrame(current_batch)
-                all_batches.append(df)
-
-                total_rows += len(current_batch)
-                pbar.update(len(current_batch))
-            else:
-                # No more data
-                break
+            current_rows = 0
+
+        for table, skipped in in_background(parse_blocks(header_info, file, schema, workers), PARSE_AHEAD):
+            bad_rows += skipped
+            if table.num_rows:
+                current_batch.append(table)
+                current_rows += table.num_rows
+                if current_rows >= batch_size:
+                    write_batch()
+
+        if current_batch:
+            write_batch()
 
     # If we collected data
-    if all_batches:
-        # Combine all batches into one DataFrame first
-        combined_df = pd.concat(all_batches, ignore_index=True)
-
-        # Define proper pandas dtypes based on EPF types
-        dtype_map = {}
-        if header_info['types'] and len(header_info['types']) == len(header_info['column_names']):
-            for i, col in enumerate(header_info['column_names']):
-                db_type = header_info['types'][i]
-                if col in combined_df.columns:  # Make sure column exists
-                    if db_type in ('INTEGER', 'BIGINT'):
-                        dtype_map[col] = 'Int64'  # Pandas nullable integer
-                    elif db_type in ('REAL', 'DOUBLE'):
-                        dtype_map[col] = 'float64'
-                    elif db_type == 'BOOLEAN':
-                        dtype_map[col] = 'boolean'
-                    else:
-                        dtype_map[col] = 'string'
-
-        # Apply pandas dtypes - using nullable types to handle missing values
-        for col, dtype in dtype_map.items():
-            try:
-                combined_df[col] = combined_df[col].astype(dtype)
-            except (ValueError, TypeError) as e:
-                print(f"Warning: Could not convert column '{col}' to {dtype}: {e}")
-                # Fall back to object type
-                combined_df[col] = combined_df[col].astype('object')
-
-        # Create a Dask DataFrame with a sensible number of partitions
-        n_partitions = min(max(1, len(all_batches)), 16)  # Cap at 16 partitions
-        ddf = dd.from_pandas(combined_df, npartitions=n_partitions)
-
-        # Write to parquet
-        ddf.to_parquet(
-            output_file,
-            engine='pyarrow',
-            compression='snappy',
-            write_index=False
-        )
+    if writer is not None:
+        writer.close()
 
         print(f"Processed {total_rows} rows into {output_file}")
+        if bad_rows:
+            print(f"Skipped {bad_rows} lines due to bad formatting - expected {len(header_info['column_names'])} fields")
 
         # Return metadata for informational purposes
         return {
             'total_rows': total_rows,
+            'bad_rows': bad_rows,
             'file': output_file,
             'name': header_info['name'],
             'date': header_info['date'],
@@ -287,7 +467,7 @@ def stream_to_parquet_with_dask(header_info, output_file, file=sys.stdin, batch_
 # Use the function
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: ./epf2parquet.py <output_file>")
+        print("Usage: ./epf2parquet.py <output_file> [workers]")
         sys.exit(1)
 
     # First read header information
@@ -300,10 +480,11 @@ if __name__ == "__main__":
     print(f"Found {len(header_info['column_names'])} columns, {len(header_info.get('primary_keys', [])) or 0} primary keys")
 
     # Then process the data
-    result = stream_to_parquet_with_dask(
+    result = stream_to_parquet(
         header_info=header_info,
         output_file=sys.argv[1],
-        batch_size=50000
+        batch_size=50000,
+        workers=int(sys.argv[2]) if len(sys.argv) > 2 else 1
     )
 
     if result: